@@ -23,65 +23,156 @@
 
 from pyArango.connection import *
 from requests.exceptions import ConnectionError
-from time import sleep
+from collections import deque
+from time import sleep, time
+import threading
+import random
+import socket
 
 # roslibpy needs a logger in order to output errors inside callbacks
 import logging
 logging.basicConfig()
 
+# Give up on reaching the database after this many seconds
+CONNECTION_TIMEOUT = 600
+
+# Messages are buffered per collection and written with a single bulk import
+# once BULK_SIZE messages are waiting or every FLUSH_INTERVAL seconds
+BULK_SIZE = 512
+FLUSH_INTERVAL = 1.0
+
+# Number of keep-alive HTTP connections kept open to the database, shared by
+# the flush thread and the API request handlers
+CONNECTION_POOL_SIZE = 32
+
+# Number of documents fetched per round-trip when loading history
+LOAD_BATCH_SIZE = 1000
+
+# History of a topic between two timestamps, in chronological order. The query
+# texts never change so ArangoDB can reuse their plans, the range is applied
+# on the header.stamp.secs index
+HISTORY_AQL = """
+FOR doc IN @@collection
+    FILTER doc.header.stamp.secs >= @start_time AND doc.header.stamp.secs <= @end_time
+    SORT doc.header.stamp.secs
+    RETURN doc
+"""
+
+# Same as HISTORY_AQL when the caller asks for a limit: only the most
+# recent documents are returned, still in chronological order
+HISTORY_LIMIT_AQL = """
+FOR doc IN (
+    FOR d IN @@collection
+        FILTER d.header.stamp.secs >= @start_time AND d.header.stamp.secs <= @end_time
+        SORT d.header.stamp.secs DESC
+        LIMIT @limit
+        RETURN d
+)
+    SORT doc.header.stamp.secs
+    RETURN doc
+"""
+
 class Database:
     def __init__(self):
         # Initiate the connection to http://iui_arangodb:8529
         print("Database: Initiating connection")
 
-        sleep(5)
-
-        # Try to connect to the database 600 times, sleeping 1 second between each try
+        # Keep trying to connect to the database for up to CONNECTION_TIMEOUT seconds
         # This is done because the database process takes a few seconds to begin responding
-        # to HTTP requests
+        # to HTTP requests. A cheap TCP probe checks the port is open before connecting and
+        # the delay between tries grows exponentially from 50 ms up to 1 second
         self.conn = None
-        for _ in range(600):
+        deadline = time() + CONNECTION_TIMEOUT
+        attempt = 0
+        while self.conn is None:
             try:
-                self.conn = Connection(arangoURL="http://iui_arangodb:8529", username="root", password="isaac", max_retries=1)
-                break
-            except ConnectionError:
-                print("Database couldn't be reached; sleeping for 1 second before retrying")
-                sleep(1)
-        if self.conn is None:
-            raise ConnectionError
+                socket.create_connection(("iui_arangodb", 8529), timeout=0.25).close()
+                self.conn = Connection(arangoURL="http://iui_arangodb:8529", username="root", password="isaac", max_retries=1, pool_maxsize=CONNECTION_POOL_SIZE)
+            except (OSError, ConnectionError):
+                if time() > deadline:
+                    raise ConnectionError
+                delay = min(0.05 * 2 ** attempt, 1.0) + random.random() * 0.05
+                print("Database couldn't be reached; sleeping for {:.2f} seconds before retrying".format(delay))
+                sleep(delay)
+                attempt += 1
 
         # Open the database
         if not self.conn.hasDatabase("isaac"):
             self.conn.createDatabase(name="isaac")
         self.db = self.conn["isaac"]
 
+        # Collection name of every ROS topic and the collection handle of
+        # every collection name, both filled in by pre_save
+        self.collection_names = {}
+        self.collections = {}
+
+        # Message buffers, one per collection, drained by the flush thread
+        self.buffers = {}
+        self.flush_lock = threading.Lock()
+        self.flush_thread = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flush_thread.start()
+
     # This function is called every time we subscribe to a new topic
     def pre_save(self, ros_topic):
-        ros_topic = ros_topic.replace("/", "_")[1:]
-        # ros_topic is now a Collection
-        print("Creating collection " + ros_topic)
-        if not self.db.hasCollection(ros_topic):
-            self.db.createCollection(name=ros_topic)
+        # collection names can't contain slashes, eg: /gnc/ekf -> gnc_ekf
+        collection = ros_topic.lstrip("/").replace("/", "_")
+        self.collection_names[ros_topic] = collection
+        # the collection and its index only need to be set up once
+        if collection in self.collections:
+            return
+        print("Creating collection " + collection)
+        if not self.db.hasCollection(collection):
+            self.db.createCollection(name=collection, waitForSync=False)
+        self.collections[collection] = self.db[collection]
         # ensure index
-        self.db[ros_topic].ensureSkiplistIndex(["header.stamp.secs"])
+        self.collections[collection].ensureSkiplistIndex(["header.stamp.secs"])
+        # create the message buffer
+        self.buffers.setdefault(collection, deque())
 
     # This function is called every time we get a new message
     def save(self, message, ros_topic):
-        ros_topic = ros_topic.replace("/", "_")[1:]
-        # Save the message
-        aql = "INSERT " + str(message) + " INTO " + ros_topic + " LET newDoc = NEW RETURN newDoc"
-        queryResult = self.db.AQLQuery(aql)
+        # Buffer the message, it will be written on the next flush
+        collection = self.collection_names[ros_topic]
+        buffer = self.buffers[collection]
+        buffer.append(message)
+        if len(buffer) >= BULK_SIZE:
+            self.flush(collection)
+
+    # Write all buffered messages of a collection with one bulk import
+    def flush(self, collection):
+        with self.flush_lock:
+            buffer = self.buffers[collection]
+            docs = [buffer.popleft() for _ in range(len(buffer))]
+            if not docs:
+                return
+            try:
+                self.collections[collection].importBulk(docs)
+            except Exception as e:
+                print("[error] could not save {} messages to {}: {}".format(len(docs), collection, e))
+
+    def flush_all(self):
+        for collection in list(self.buffers):
+            self.flush(collection)
+
+    def flush_loop(self):
+        while True:
+            sleep(FLUSH_INTERVAL)
+            self.flush_all()
 
-    def load(self, ros_topic, start_time=None, end_time=None):
+    def load(self, ros_topic, start_time, end_time, limit=None):
         # warning! timestamps are in milliseconds since epoch, not seconds
-        aql = ""
-        if start_time is not None and end_time is not None:
-            ros_topic = ros_topic.replace("/", "_")[1:]
+        bind_vars = {
+            "@collection": self.collection_names[ros_topic],
+            "start_time": start_time,
+            "end_time": end_time,
+        }
+        query = HISTORY_AQL
 
-            aql = "FOR doc IN " + ros_topic + "\n"\
-                + "\tFILTER doc.header.stamp.secs >= " + str(start_time) + \
-                      " AND doc.header.stamp.secs <= " + str(end_time) + "\n" \
-                + "\tRETURN doc";
+        # the whole range is returned unless a limit is given
+        if limit is not None:
+            bind_vars["limit"] = limit
+            query = HISTORY_LIMIT_AQL
 
-        result = list(self.db.AQLQuery(aql, rawResults = True))
-        return result
+        # the cursor is returned as is, documents are fetched from the
+        # database LOAD_BATCH_SIZE at a time while it is iterated over
+        return self.db.AQLQuery(query, rawResults = True, batchSize = LOAD_BATCH_SIZE, bindVars = bind_vars)
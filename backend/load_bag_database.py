@@ -33,6 +33,10 @@ import time
 import logging
 logging.basicConfig()
 
+# Fixed insert query, the document and collection are passed as bind
+# parameters so ArangoDB can reuse the parsed query for every message
+INSERT_AQL = "INSERT @doc INTO @@collection"
+
 class LoadBagDatabase:
     def __init__(self, path, topics):
         # Initiate the connection to http://127.0.0.1:8529
@@ -81,8 +85,7 @@ class LoadBagDatabase:
             for subtopic, msg, t in bag.read_messages(topic_name):
                 msg = yaml.safe_load(str(msg))
 
-                aql = "INSERT " + str(msg) + " INTO " + "yo" + " LET newDoc = NEW RETURN newDoc"
-                queryResult = self.db.AQLQuery(aql)
+                queryResult = self.db.AQLQuery(INSERT_AQL, bindVars={"doc": msg, "@collection": "yo"})
         bag.close()
 
 # Database connection
@@ -19,21 +19,38 @@
 # Backend API
 # ----------------------------------------------------------------------------------------------------
 
-from flask import Flask, abort, jsonify
+from flask import Flask, Response, abort, jsonify, request
 from database import Database
 from ros_connection import ROSConnection
 from time import time
-import json
+import atexit
+import orjson
+import os
 import sys
 
 def log(message):
     print("[{}] {}".format(int(time()), message))
     sys.stdout.flush()
 
+CONFIG_PATH = "/config.json"
+
+# parsed configuration and its serialized form, along with
+# the modification time of the file they were read from
+config_cache = {"mtime": None, "configuration": None, "bytes": b""}
+
+def load_configuration():
+    # only re-read the configuration file if it changed on disk
+    mtime = os.stat(CONFIG_PATH).st_mtime
+    if mtime != config_cache["mtime"]:
+        with open(CONFIG_PATH, "rb") as f:
+            config_cache["configuration"] = orjson.loads(f.read())
+        config_cache["bytes"] = orjson.dumps(config_cache["configuration"])
+        config_cache["mtime"] = mtime
+    return config_cache["configuration"]
+
 log("opening config")
 # Load yaml configuration file
-with open("/config.json", "r") as f:
-    configuration = json.load(f)
+configuration = load_configuration()
 log("config loaded")
 
 # Flask application (API)
@@ -44,6 +61,9 @@ log("establishing db conn")
 database_connection = Database()
 log("db conn established")
 
+# write out any buffered messages when the backend shuts down
+atexit.register(database_connection.flush_all)
+
 log("establishing ros bridge conn")
 # ROS bridge connection
 ros_connection = ROSConnection(
@@ -52,6 +72,9 @@ ros_connection = ROSConnection(
 )
 log("ros bridge conn established")
 
+# save queued messages before the buffers are flushed on shutdown
+atexit.register(ros_connection.drain_queue)
+
 
 def unsluggify_ros_topic(ros_topic):
     # warning! we can't use ros topic names in URLs (because
@@ -61,19 +84,40 @@ def unsluggify_ros_topic(ros_topic):
     # 1. remove prefixed /
     # 2. replace any other / with two _
     #
-    return "/" + ros_topic.replace("__", "/")
+    # the slugs of subscribed topics are computed once by
+    # the ROS connection, other slugs are converted back
+    # here so that they can be reported as not found
+    ros_topic_name = ros_connection.slug_to_topic.get(ros_topic)
+    if ros_topic_name is None:
+        ros_topic_name = "/" + ros_topic.replace("__", "/")
+    return ros_topic_name
+
+
+def stream_json_array(documents, chunk_size=64 * 1024):
+    # serialize documents into a JSON array piece by piece
+    # so that a long history is never held in memory at once
+    chunk = bytearray(b"[")
+    separator = b""
+    for document in documents:
+        chunk += separator
+        chunk += orjson.dumps(document)
+        separator = b","
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk.clear()
+    chunk += b"]"
+    yield bytes(chunk)
 
 
 @app.route('/config.json')
 def config_request():
     # this enables hot reconfigurations to occur
     # because it will re-read the config.json file
-    # on each API call (i.e.: if you change your config
+    # whenever it changes (i.e.: if you change your config
     # you just need to refresh the frontend page)
     global configuration
-    with open("/config.json", "r") as f:
-        configuration = json.load(f)
-    return json.dumps(configuration), 200, {'Content-Type': 'application/json'}
+    configuration = load_configuration()
+    return config_cache["bytes"], 200, {'Content-Type': 'application/json'}
 
 
 @app.route('/history/<ros_topic>/start/<start_time>/end/<end_time>')
@@ -85,24 +129,37 @@ def history_time_bound(ros_topic, start_time, end_time):
     if end_time <= start_time:
         abort(400)
 
-    if not (ros_topic in ros_connection.available_ros_topics):
+    # optionally only the most recent documents are returned,
+    # e.g.: /history/gnc__ekf/start/0/end/1000?limit=100
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400)
+        if limit <= 0:
+            abort(400)
+
+    if not (ros_topic in ros_connection.available_ros_topics_set):
         abort(404)
 
     result = database_connection.load(
-        ros_topic=ros_topic, start_time=start_time, end_time=end_time,
+        ros_topic=ros_topic, start_time=start_time, end_time=end_time, limit=limit,
     )
 
-    return json.dumps(result)
+    return Response(stream_json_array(result), content_type='application/json')
 
 
 @app.route('/topics')
 def ros_topic_list():
-    return json.dumps(ros_connection.available_ros_topics)
+    return orjson.dumps(ros_connection.available_ros_topics), 200, {'Content-Type': 'application/json'}
 
 
+# In the container the API is served by gunicorn (see docker-compose.yml),
+# running this file directly starts the Flask development server instead
 if __name__ == "__main__":
     print("Launching IDI Backend with the following configuration:")
     print(configuration)
     print("\n")
 
-    app.run(debug=True, host="0.0.0.0", port=9091)
+    app.run(debug=True, use_reloader=False, threaded=True, host="0.0.0.0", port=9091)
@@ -24,22 +24,36 @@
 # ----------------------------------------------------------------------------------------------------
 
 import roslibpy
+import threading
+import random
+import queue
 import time
 import os
 
+# Maximum number of messages waiting to be saved, newer messages are
+# dropped while the queue is full
+MESSAGE_QUEUE_SIZE = 10000
+
+# Number of threads saving queued messages to the database
+SAVE_WORKERS = 2
+
 class ROSConnection:
     def __init__(self, database_connection, configuration):
         self.database_connection = database_connection
         self.configuration = configuration
 
         self.ros = roslibpy.Ros(host=os.getenv('ROS_BRIDGE_IP','rosbridge'), port=int(os.getenv('ROS_BRIDGE_PORT',9090)))
+        # retry until rosbridge is up, the delay between tries
+        # grows exponentially from 50 ms up to 5 seconds
+        attempt = 0
         while True:
             try:
                 self.ros.run()
                 break
             except Exception as e:
                 print("[error] could not connect to rosbridge, will try again")
-                time.sleep(5)
+                time.sleep(min(0.05 * 2 ** attempt, 5.0) + random.random() * 0.05)
+                attempt += 1
         
         assert self.ros.is_connected
 
@@ -47,7 +61,16 @@ class ROSConnection:
         self.subscribers = []
 
         # list of all ROS topics available to sub/pub from/to
+        # the set holds the same topics for fast membership checks
         self.available_ros_topics = []
+        self.available_ros_topics_set = set()
+
+        # messages are saved by worker threads so that database writes
+        # never block the rosbridge callbacks
+        self.message_queue = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+        self.dropped_messages = 0
+        for _ in range(SAVE_WORKERS):
+            threading.Thread(target=self.save_worker, daemon=True).start()
 
         # fix ros message type for all log objects
         for i, j in enumerate(self.configuration["logs"]):
@@ -58,20 +81,42 @@ class ROSConnection:
             topic_name, topic_type = topic_config['ros']['topic'], topic_config['ros']['type']
 
             # check if topic has already been subscribed to
-            if topic_name in self.available_ros_topics:
+            if topic_name in self.available_ros_topics_set:
                 continue
 
             self.available_ros_topics.append(
                 topic_name
             )
+            self.available_ros_topics_set.add(topic_name)
             self.subscribe(
                 ros_topic=topic_name,
                 message_type=topic_type,
             )
 
+        # ROS topics can't be used in URLs as is, so the API refers to
+        # them by slug (eg: /gnc/ekf -> gnc__ekf), see main.py
+        self.slug_to_topic = {
+            topic.lstrip("/").replace("/", "__"): topic
+            for topic in self.available_ros_topics
+        }
+
     def close(self):
         self.ros.terminate()
 
+    # wait until every queued message has been handed to the database
+    def drain_queue(self):
+        self.message_queue.join()
+
+    def save_worker(self):
+        while True:
+            message, ros_topic = self.message_queue.get()
+            try:
+                self.database_connection.save(message=message, ros_topic=ros_topic)
+            except Exception as e:
+                print("[error] could not save message from {}: {}".format(ros_topic, e))
+            finally:
+                self.message_queue.task_done()
+
     def callback(self, message, ros_topic):
         # TODO this is temporary, fix this
         # ideally the time should be correct from the Astrobee sim
@@ -87,8 +132,13 @@ class ROSConnection:
                     'secs': time_now
                 }
             }
-        
-        self.database_connection.save(message=message, ros_topic=ros_topic)
+
+        try:
+            self.message_queue.put_nowait((message, ros_topic))
+        except queue.Full:
+            self.dropped_messages += 1
+            if self.dropped_messages % 1000 == 1:
+                print("[error] message queue is full, {} messages dropped so far".format(self.dropped_messages))
 
     def subscribe(self, ros_topic, message_type):
         print("Subscribing to topic " + ros_topic + " of type " + message_type)
@@ -1,74 +1,146 @@
 from cropper import make_tile
 import argparse
-import string
-import random
+from os import environ, makedirs, cpu_count, scandir, symlink, link
+
+# textures are converted by one worker process per core, libvips threads
+# within each worker would only oversubscribe the CPU. This has to be
+# set before libvips is loaded
+environ.setdefault("VIPS_CONCURRENCY", "1")
+
+import pyvips
+import tempfile
+import threading
 import subprocess
-from os import mkdir
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import os.path as op
-from glob import glob
-from shutil import copyfile, rmtree
+from shutil import copyfile, move, rmtree
+
+# worker processes converting textures, started on first use and
+# reused by every tile generated in this process
+texture_pool = None
+texture_pool_lock = threading.Lock()
+
+def get_texture_pool():
+    # tiles are generated by several threads, forking workers from a threaded process
+    # can copy locks (e.g. stdout's) held by another thread and deadlock the worker.
+    # Workers are started from a forkserver instead, which has a single thread
+    global texture_pool
+    with texture_pool_lock:
+        if texture_pool is None:
+            texture_pool = ProcessPoolExecutor(max_workers=cpu_count(),
+                mp_context=multiprocessing.get_context("forkserver"))
+        return texture_pool
+
+# textures converted so far, tiles made with the same quality and scale
+# share them: (png path, quality, scale) -> (future, converted jpg path)
+converted_textures = {}
+converted_textures_lock = threading.Lock()
+converted_textures_dir = None
+
+def get_converted_texture(png_file, quality, scale):
+    global converted_textures_dir
+    key = (png_file, str(quality), str(scale))
+    with converted_textures_lock:
+        if key not in converted_textures:
+            if converted_textures_dir is None:
+                converted_textures_dir = tempfile.mkdtemp(prefix="chop_textures_")
+                atexit.register(rmtree, converted_textures_dir, True)
+            output_jpg = converted_textures_dir + "/" + str(len(converted_textures)) + ".jpg"
+            future = get_texture_pool().submit(convert_png, png_file, output_jpg, quality, scale)
+            converted_textures[key] = (future, output_jpg)
+        return converted_textures[key]
 
 def run(command):
-    subprocess.run(command, shell=True, check=True)
-
-def random_string(N):
-    return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(N))
+    # command is an argument list, it is executed without a shell
+    subprocess.run(command, check=True)
+
+def convert_png(png_file, output_jpg, quality, scale):
+    print(f"converting {png_file} to {output_jpg} at {quality}% quality")
+    image = pyvips.Image.new_from_file(png_file, access="sequential")
+    if image.hasalpha():
+        # jpg has no alpha channel, keep the color bands only
+        image = image.extract_band(0, n=image.bands - 1)
+    if float(scale) != 100:
+        image = image.resize(float(scale) / 100)
+    image.jpegsave(output_jpg, Q=int(quality), strip=True, optimize_coding=True)
 
 def gen_tile(input,output,b3dm,crop,min_x,min_y,min_z,max_x,max_y,max_z,quality,scale):
-    tmp_dir = "/tmp/" + random_string(20)
-    mkdir(tmp_dir)
-
-    obj_filename = input.split("/")[-1]
-    tmp_cropped_obj = tmp_dir+"/"+obj_filename
-
-    mtl_filename = obj_filename.replace(".obj",".mtl")
-
-    if crop:
-        print(f"making cropped version of {input} at {tmp_cropped_obj}")
-        make_tile(input_file=op.abspath(input), 
-            output_file=tmp_cropped_obj, 
-            maxX=max_x, maxY=max_y, maxZ=max_z, 
-            minX=min_x, minY=min_y, minZ=min_z)
-        print("cropping completed")
-    else:
-        print("not cropping, set --crop to true to crop to x/y/z min/max")
-        copyfile(op.abspath(input),tmp_cropped_obj)
-
-
-    parent_dir = op.dirname(op.abspath(input))
-
-    for png_file in glob(parent_dir+"/*.png"):
-        png_filename = png_file.split("/")[-1].replace(".png", ".jpg")
-        output_jpg = tmp_dir + "/" + png_filename
-
-        print(f"converting {png_file} to {output_jpg} at {quality}% quality")
-
-        run('convert -resize '+ scale +'% -quality '+ quality +'% "'+ png_file +'" "'+ output_jpg +'"')
-
-    # copy over mtl
-    src_mtl = parent_dir+"/"+mtl_filename
-    dst_mtl = tmp_dir+"/"+mtl_filename
-    copyfile(src_mtl, dst_mtl)
-
-    # replace mtl png with jpg
-    fin = open(dst_mtl, "rt")
-    data = fin.read()
-    data = data.replace('.png', '.jpg')
-    fin.close()
-    fin = open(dst_mtl, "wt")
-    fin.write(data)
-    fin.close()
-
-    if not b3dm:
-        print("running glb maker")
-        run(f"obj2gltf -i {op.abspath(tmp_cropped_obj)} -b -o {op.abspath(output)}")
-    else:
-        print("running b3dm maker")
-        b3dm_tmp_path = op.abspath(tmp_cropped_obj).replace(".obj",".b3dm")
-        run(f"obj23dtiles -i {op.abspath(tmp_cropped_obj)} -b --b3dm -o {b3dm_tmp_path}")
-        copyfile(b3dm_tmp_path, op.abspath(output))
-
-    rmtree(tmp_dir)
+    # resolved once, the temporary directory below is always absolute
+    input_path = op.abspath(input)
+    output_path = op.abspath(output)
+    makedirs(op.dirname(output_path), exist_ok=True)
+
+    # the temporary directory is removed when done, even if a step fails
+    with tempfile.TemporaryDirectory(prefix="chop_") as tmp_dir:
+        obj_filename = op.basename(input)
+        tmp_cropped_obj = tmp_dir+"/"+obj_filename
+
+        mtl_filename = op.splitext(obj_filename)[0] + ".mtl"
+
+        if crop:
+            print(f"making cropped version of {input} at {tmp_cropped_obj}")
+            make_tile(input_file=input_path, 
+                output_file=tmp_cropped_obj, 
+                maxX=max_x, maxY=max_y, maxZ=max_z, 
+                minX=min_x, minY=min_y, minZ=min_z)
+            print("cropping completed")
+        else:
+            print("not cropping, set --crop to true to crop to x/y/z min/max")
+            # the uncropped obj is only read, so link to it instead of copying it
+            try:
+                symlink(input_path,tmp_cropped_obj)
+            except OSError:
+                copyfile(input_path,tmp_cropped_obj)
+
+
+        parent_dir = op.dirname(input_path)
+
+        src_mtl = parent_dir+"/"+mtl_filename
+        dst_mtl = tmp_dir+"/"+mtl_filename
+        with open(src_mtl, "rb") as f:
+            mtl_data = f.read()
+
+        # only the png textures used by the mtl (map_Kd, map_Ka... lines) are converted,
+        # other pngs in the same directory don't end up in the tile
+        textures = set()
+        for line in mtl_data.splitlines():
+            line_elements = line.split()
+            if line_elements and line_elements[0].startswith(b"map_") and line_elements[-1].endswith(b".png"):
+                textures.add(op.basename(line_elements[-1].decode()))
+
+        # textures are converted in parallel, one worker process per core, and
+        # only once for all the tiles made with the same quality and scale
+        converted = []
+        with scandir(parent_dir) as entries:
+            for entry in entries:
+                if not (entry.name in textures and entry.is_file()):
+                    continue
+                output_jpg = tmp_dir + "/" + entry.name[:-len(".png")] + ".jpg"
+
+                converted.append((get_converted_texture(entry.path, quality, scale), output_jpg))
+
+        for (future, converted_jpg), output_jpg in converted:
+            future.result()
+            try:
+                link(converted_jpg, output_jpg)
+            except OSError:
+                copyfile(converted_jpg, output_jpg)
+
+        # copy over mtl, replacing mtl png with jpg on the way
+        with open(dst_mtl, "wb") as f:
+            f.write(mtl_data.replace(b".png", b".jpg"))
+
+        if not b3dm:
+            print("running glb maker")
+            run(["obj2gltf", "-i", tmp_cropped_obj, "-b", "-o", output_path])
+        else:
+            print("running b3dm maker")
+            b3dm_tmp_path = op.splitext(tmp_cropped_obj)[0] + ".b3dm"
+            run(["obj23dtiles", "-i", tmp_cropped_obj, "-b", "--b3dm", "-o", b3dm_tmp_path])
+            # a rename when the tile is on the same filesystem, a copy otherwise
+            move(b3dm_tmp_path, output_path)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
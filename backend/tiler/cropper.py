@@ -1,3 +1,77 @@
+import mmap
+import os
+import threading
+import numpy as np
+
+# the last OBJ parsed by read_obj, shared by every tile cut from it in this process:
+# (path, modification time) -> (vertices, faces, face_offsets)
+parsed_obj = {}
+parsed_obj_lock = threading.Lock()
+
+def read_obj(input_file):
+    # tiles are cut from the same OBJ many times over, it is only parsed again if it changed
+    key = (input_file, os.stat(input_file).st_mtime_ns)
+    with parsed_obj_lock:
+        if key not in parsed_obj:
+            parsed_obj.clear()
+            parsed_obj[key] = parse_obj(input_file)
+        return parsed_obj[key]
+
+def parse_obj(input_file):
+    with open(input_file, 'rb') as obj_file:
+        # an empty file can't be memory mapped, it has no vertices and no faces
+        if os.fstat(obj_file.fileno()).st_size == 0:
+            return np.empty((0, 3), dtype=np.float64), np.empty((0, 3), dtype=np.int64), np.empty(0, dtype=np.int64)
+        obj_map = mmap.mmap(obj_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with obj_map:
+
+        # ************************ PARSE VERTICES AND FACES ************************
+        # vertices are only parsed here, the bounding box test is done on all of them at once in make_tile
+
+        vertices = []       # x y z fields (as bytes) of every "v" line, in order
+        faces = []          # v1 v2 v3 of every "f" line, in order
+        face_offsets = []   # byte offset of every "f" line
+
+        line_offset = 0
+        # only "v" and "f" lines are split, every other line (vt, vn, usemtl, comments...)
+        # is recognized from its first bytes and skipped
+        for line in iter(obj_map.readline, b""):
+            if line.startswith((b"v ", b"v\t")):
+                line_type = b"v"
+            elif line.startswith((b"f ", b"f\t")):
+                line_type = b"f"
+            elif line[:1].isspace():
+                # indented lines are rare, their type is their first element
+                line_type = (line.split(None, 1) or [None])[0]
+            else:
+                line_type = None
+
+            if line_type == b"v":
+                #  a "v" line looks like this:
+                #  v x y z ...
+                vertices += line.split(None, 4)[1:4]
+
+            elif line_type == b"f":
+                #  a "f" line looks like this:
+                #  f v1/vt1/vn1 v2/vt2/vn2 v3/vt3/vn3 ...
+                # Note that v1, v2 and v3 are the first "/" separated elements within each line element.
+                v1, v2, v3 = line.split(None, 4)[1:4]
+                faces.append((int(v1.split(b'/', 1)[0]), int(v2.split(b'/', 1)[0]), int(v3.split(b'/', 1)[0])))
+                face_offsets.append(line_offset)
+
+            line_offset += len(line)
+
+    # all vertex coordinates are converted to floats in a single call
+    vertices = np.fromstring(b" ".join(vertices), dtype=np.float64, sep=" ").reshape(-1, 3)
+    faces = np.array(faces, dtype=np.int64).reshape(-1, 3)
+    # relative (negative) or out of range vertex numbers are replaced by 0, which is never
+    # a valid vertex number, so that faces can be looked up without checking them first
+    faces[(faces < 1) | (faces > len(vertices))] = 0
+    face_offsets = np.array(face_offsets, dtype=np.int64)
+
+    return vertices, faces, face_offsets
+
 def make_tile(input_file,output_file,maxX,maxY,maxZ,minX,minY,minZ):
 
     # bounding_box = [  11.8,-7.1,4.01,  9.8, -9.8,3.9    ]
@@ -9,83 +83,47 @@ def make_tile(input_file,output_file,maxX,maxY,maxZ,minX,minY,minZ):
     # minY = bounding_box[4]
     # minZ = bounding_box[5]
 
-    v_keepers = dict()  # keeps track of which vertices are within the bounding box
-
-    kept_vertices = 0
-    discarded_vertices = 0
-
-    kept_faces = 0
-    discarded_faces = 0
-
-    discarded_lines = 0
-    kept_lines = 0
-
-    obj_file = open(input_file, 'r')
-    new_obj_file = open(output_file, 'w')
-
-    # the number of the next "v" vertex lines to process.
-    original_v_number = 1  # the number of the next "v" vertex lines to process.
-    # the new ordinal position of this vertex if out of bounds vertices were discarded.
-    new_v_number = 1
-
-    for line in obj_file:
-        line_elements = line.split()
-
-        # Python doesn't have a SWITCH statement, but we only have three cases, so we'll just use cascading if stmts
-        # if it isn't an "f" type line (face definition)
-        if line_elements[0] != "f":
-
-            # and it isn't an "v" type line either (vertex definition)
-            if line_elements[0] != "v":
-                # ************************ PROCESS ALL NON V AND NON F LINE TYPES ******************
-                # then we just copy it unchanged from the input OBJ to the output OBJ
-                new_obj_file.write(line)
-                kept_lines = kept_lines + 1
-
-            else:  # then line_elements[0] == "v":
-                # ************************ PROCESS VERTICES ****************************************
-                #  a "v" line looks like this:
-                #  f x y z ...
-                x = float(line_elements[1])
-                y = float(line_elements[2])
-                z = float(line_elements[3])
-
-                if minX < x < maxX and minY < y < maxY and minZ < z < maxZ:
-                    # if vertex is within  the bounding box, we include it in the new OBJ file
-                    new_obj_file.write(line)
-                    v_keepers[str(original_v_number)] = str(new_v_number)
-                    new_v_number = new_v_number + 1
-                    kept_vertices = kept_vertices + 1
-                    kept_lines = kept_lines + 1
-                else:     # if vertex is NOT in the bounding box
-                    new_obj_file.write(line)
-                    discarded_vertices = discarded_vertices + 1
-                    discarded_lines = discarded_lines + 1
-                original_v_number = original_v_number + 1
-
-        else:  # line_elements[0] == "f":
-            # ************************ PROCESS FACES ****************************************
-            #  a "f" line looks like this:
-            #  f v1/vt1/vn1 v2/vt2/vn2 v3/vt3/vn3 ...
-
-            #  We need to delete any face lines where ANY of the 3 vertices v1, v2 or v3 are NOT in v_keepers.
-
-            v = ["", "", ""]
-            # Note that v1, v2 and v3 are the first "/" separated elements within each line element.
-            for i in range(0, 3):
-                v[i] = line_elements[i+1].split('/')[0]
-
-            # now we can check if EACH of these 3 vertices are  in v_keepers.
-            # for each f line, we need to determine if all 3 vertices are in the v_keepers list
-            if v[0] in v_keepers and v[1] in v_keepers and v[2] in v_keepers:
-                new_obj_file.write(line)
-                kept_lines = kept_lines + 1
-                kept_faces = kept_faces + 1
-            else:  # at least one of the vertices in this face has been deleted, so we need to delete the face too.
-                discarded_lines = discarded_lines + 1
-                discarded_faces = discarded_faces + 1
-                new_obj_file.write("# CROPPED "+line)
-
-    # end of line processing loop
-    obj_file.close()
-    new_obj_file.close()
+    vertices, faces, face_offsets = read_obj(input_file)
+
+    # ************************ BOUNDING BOX TEST ****************************************
+    # v_keepers[i] is True if vertex number i is within the bounding box
+    # OBJ vertex numbers start at 1, so v_keepers[0] is never set
+    v_keepers = np.zeros(len(vertices) + 1, dtype=np.bool_)
+
+    # the box is tested one axis at a time and the results are combined in place,
+    # so no temporary as large as the vertex array is needed
+    inside = v_keepers[1:]
+    inside[:] = True
+    for axis, (bbox_min, bbox_max) in enumerate(((minX, maxX), (minY, maxY), (minZ, maxZ))):
+        coordinates = vertices[:, axis]
+        inside &= bbox_min < coordinates
+        inside &= coordinates < bbox_max
+
+    # We need to delete any face lines where ANY of the 3 vertices v1, v2 or v3 are NOT in v_keepers.
+    # Relative (negative) or out of range vertex numbers were set to 0 when parsing, so they are never kept
+    kept_faces = v_keepers[faces[:, 0]]
+    kept_faces &= v_keepers[faces[:, 1]]
+    kept_faces &= v_keepers[faces[:, 2]]
+
+    cropped_offsets = face_offsets[~kept_faces]
+
+    # ************************ WRITE THE NEW OBJ ******************************
+    # every line is copied unchanged, except faces that have been cropped: at least one of
+    # their vertices has been deleted, so we need to delete (comment out) the face too.
+    # the OBJ is memory mapped: the OS pages it in as it is read, and the output
+    # is built from slices of the map instead of a copy of every line
+    output = []
+    with open(input_file, 'rb') as obj_file:
+        # an empty file can't be memory mapped, the new OBJ is empty too
+        if os.fstat(obj_file.fileno()).st_size > 0:
+            with mmap.mmap(obj_file.fileno(), 0, access=mmap.ACCESS_READ) as obj_map:
+                copied_offset = 0
+                for offset in cropped_offsets.tolist():
+                    output.append(obj_map[copied_offset:offset])
+                    output.append(b"# CROPPED ")
+                    copied_offset = offset
+                output.append(obj_map[copied_offset:])
+
+    # the new OBJ is assembled in memory and written with a single call
+    with open(output_file, 'wb') as new_obj_file:
+        new_obj_file.write(b"".join(output))
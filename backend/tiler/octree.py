@@ -1,156 +1,225 @@
-import open3d as o3d
-from chopper import gen_tile as gt
+from chopper import gen_tile as gt, get_texture_pool
+from cropper import read_obj
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 import argparse
 import os
 import os.path as op
+import numpy as np
+from shutil import rmtree
 
-def gen_tile(tile_dir, obj_path, tree_counter, x_min, x_max, y_min, y_max, z_min, z_max, quality=60, scale=6.25):
-    gt(obj_path, tile_dir+"/"+tree_counter, True, True, x_min, x_max, y_min, y_max, z_min, z_max, quality, scale)
-
-parser = argparse.ArgumentParser()
-
-parser.add_argument('--input', help='path to .obj file (that links to .mtl with same name & 1 or more .png files linked from .mtl file)', type=str, required=True)
-parser.add_argument('--output', help='path to new directory that will contain tileset.json and multiple .b3dm files', type=str, required=True)
-
-args = parser.parse_args()
-
-obj_path = op.abspath(args.input)
-tile_dir = op.abspath(args.output)
-
-assert op.exists(obj_path)
-assert obj_path.endswith(".obj")
-assert not op.exists(tile_dir)
-os.mkdir(tile_dir)
-
-tree = {
-    "asset": {
-        "version": "1.0",
-        "gltfUpAxis": "Z"
-    },
-    "root": {
-        "children":[]
-    },
-    "geometricError": 1.1
-}
-
-tree_counter = -1
-
-def f_traverse(node, node_info):
-    global tree_counter
-    tree_counter += 1
-
-    early_stop = False
-
-    # Global min bound (include). A point is within bound iff origin <= point < origin + size.
-    # ref: http://www.open3d.org/docs/latest/python_api/open3d.geometry.Octree.html
-    o,s = node_info.origin, node_info.size
-    x,y,z = o[0],o[1],o[2]
-
-    # fixing edges between 3d tiles
-    # apparently tiles need to overlap lol wtf
-    s += s/10.0
-
-    hl = s/2.0
-
-    x_mid = x+hl
-    y_mid = y+hl
-    z_mid = z+hl
-
-
-    box_boundaries = [
-        x_mid,
-        y_mid,
-        z_mid,
-        hl,
-        0,
-        0,
-        0,
-        hl,
-        0,
-        0,
-        0,
-        hl
-    ]
-
-    if node_info.depth == 0:
-        tree['root']['boundingVolume'] = {
-            "box": box_boundaries
-        }
-        tree['root']["content"] = {
-            "uri": str(tree_counter)+".b3dm"
-        }
-        tree['root']["geometricError"] = 1.0
-        tree['root']["refine"]= "REPLACE"
-
-        gen_tile(tile_dir, obj_path, tree_counter, x, x+s, y, y+s, z, z+s, quality=60, scale=6.25)
-
-    elif node_info.depth == 1:
-        obj = {
-            'boundingVolume': {
-                "box":box_boundaries
-            }
-        }
-        obj["geometricError"]  = 0.25
-        obj["content"] = {
-            "uri": str(tree_counter)+".b3dm"
-        }
-        obj['children'] = []
-        tree['root']['children'].append(obj)
-
-        gen_tile(tile_dir, obj_path, tree_counter, x, x+s, y, y+s, z, z+s, quality=60, scale=12.5)
-    
-    else:
-        obj = {
-            'boundingVolume': {
-                "box":box_boundaries
-            }
-        }
-        obj["geometricError"] = 0.1
-        obj["content"] = {
-            "uri": str(tree_counter)+".b3dm"
-        }
-
-        obj_set = False
-
-        try:
-            gen_tile(tile_dir, obj_path, tree_counter, x, x+s, y, y+s, z, z+s, quality=75, scale=25)
-            obj_set = True
-        except Exception as e:
-            print("[exception in level 2 of octree]", e)
+# default number of octree levels below the root tile
+MAX_DEPTH = 2
 
-        if obj_set:
-            for i,j in enumerate(tree['root']['children']):
-                if len(j['children']) < 8:
-                    parent_volume = j['boundingVolume']["box"]
-                    p_x,p_y,p_z,p_hl = parent_volume[0],parent_volume[1],parent_volume[2],parent_volume[3]
+# tiles are cropped to their octree cell grown by this fraction of its size
+TILE_OVERLAP = 0.1
 
-                    if  ((p_x-p_hl) <= x_mid <= (p_x+p_hl)) and \
-                        ((p_y-p_hl) <= y_mid <= (p_y+p_hl)) and \
-                        ((p_z-p_hl) <= z_mid <= (p_z+p_hl)):
+# origin of the 8 children of an octree cell, as a fraction of the cell size
+CHILD_OFFSETS = np.array([(i & 1, (i >> 1) & 1, (i >> 2) & 1) for i in range(8)]) / 2.0
 
+# texture quality and scale (in %) and geometric error of the tiles at
+# every depth, starting from the root. Deeper tiles use the last entry
+DEPTH_CONFIG = (
+    (60, 6.25, 1.0),
+    (60, 12.5, 0.25),
+    (75, 25, 0.1),
+)
 
-                        tree['root']['children'][i]['children'].append(obj)
-                        break
-
-
-    return early_stop
-
-
-print("[a] Reading mesh from {}".format(obj_path))
-mesh = o3d.io.read_triangle_mesh(obj_path)
-
-print("[b] Read mesh:",mesh)
-voxel_grid = o3d.geometry.VoxelGrid.create_from_triangle_mesh(mesh, voxel_size=0.5)
-
-print("[c] Created voxel grid:",voxel_grid)
-octree = o3d.geometry.Octree(max_depth=2)
-octree.create_from_voxel_grid(voxel_grid)
-
-print("[d] Created octree:",octree)
-octree.traverse(f_traverse)
+def gen_tile(tile_dir, obj_path, tree_counter, x_min, x_max, y_min, y_max, z_min, z_max, quality=60, scale=6.25):
+    # chopper runs in this process, its bounds are ordered min x/y/z then max x/y/z
+    gt(obj_path, tile_dir+"/"+str(tree_counter)+".b3dm", True, True, x_min, y_min, z_min, x_max, y_max, z_max, quality, scale)
+
+class TilesetBuilder:
+    def __init__(self, tile_dir, obj_path, max_depth=MAX_DEPTH):
+        self.tile_dir = tile_dir
+        self.obj_path = obj_path
+        self.max_depth = max_depth
+
+        self.tree = {
+            "asset": {
+                "version": "1.0",
+                "gltfUpAxis": "Z"
+            },
+            "root": {
+                "children":[]
+            },
+            "geometricError": 1.1
+        }
 
-with open(tile_dir+'/tileset.json', 'w', encoding='utf-8') as f:
-    json.dump(tree, f, ensure_ascii=False, indent=4)
+        self.tree_counter = -1
+
+        # last tile visited at every depth, tiles visited after it
+        # at the next depth are its children
+        self.last_nodes = {}
+
+        # tiles are generated after the traversal, each job is
+        # (gen_tile arguments, children list the tile is in or None, tileset node)
+        self.jobs = []
+
+    def visit(self, origin, size, depth):
+        self.tree_counter += 1
+        tree = self.tree
+
+        # Global min bound (include). A point is within bound iff origin <= point < origin + size.
+        o,s = origin, size
+        x,y,z = o[0],o[1],o[2]
+
+        # fixing edges between 3d tiles
+        # apparently tiles need to overlap lol wtf
+        s += s*TILE_OVERLAP
+
+        hl = s/2.0
+
+        x_mid = x+hl
+        y_mid = y+hl
+        z_mid = z+hl
+
+
+        box_boundaries = (
+            x_mid,
+            y_mid,
+            z_mid,
+            hl,
+            0,
+            0,
+            0,
+            hl,
+            0,
+            0,
+            0,
+            hl
+        )
+
+        # the same for every depth
+        uri = str(self.tree_counter)+".b3dm"
+        quality, scale, geometric_error = DEPTH_CONFIG[min(depth, len(DEPTH_CONFIG) - 1)]
+        tile_args = (self.tile_dir, self.obj_path, self.tree_counter, x, x+s, y, y+s, z, z+s, quality, scale)
+
+        if depth == 0:
+            obj = tree['root']
+            obj['boundingVolume'] = {
+                "box": box_boundaries
+            }
+            obj["content"] = {
+                "uri": uri
+            }
+            obj["geometricError"] = geometric_error
+            obj["refine"]= "REPLACE"
+            children = None
+
+        else:
+            obj = {
+                'boundingVolume': {
+                    "box":box_boundaries
+                }
+            }
+            obj["geometricError"] = geometric_error
+            obj["content"] = {
+                "uri": uri
+            }
 
-print("[e] Completed!")
\ No newline at end of file
+            # the octree is traversed depth first, so the parent of this
+            # node is the last node that was visited one level up
+            children = self.last_nodes[depth - 1]['children']
+            children.append(obj)
+
+        if depth < self.max_depth:
+            obj.setdefault('children', [])
+            self.last_nodes[depth] = obj
+
+        # the root and level 1 tiles are required, deeper tiles are
+        # left out of the tileset if they can't be generated
+        self.jobs.append((tile_args, children if depth >= 2 else None, obj))
+
+    def subdivide(self, face_min, face_max, origin, size, depth=0):
+        # cells are split in 8 and visited depth first. The cropper only keeps the faces
+        # that are entirely within a tile, so cells whose tile would have no faces are
+        # skipped along with their children (which can only hold a subset of those faces)
+        tile_min, tile_max = origin, origin + size * (1 + TILE_OVERLAP)
+        # the faces are tested one axis at a time, each axis only
+        # against the faces that passed the previous ones
+        kept = np.flatnonzero((tile_min[0] < face_min[:, 0]) & (face_max[:, 0] < tile_max[0]))
+        for axis in (1, 2):
+            kept = kept[(tile_min[axis] < face_min[kept, axis]) & (face_max[kept, axis] < tile_max[axis])]
+        if len(kept) == 0:
+            return
+
+        self.visit(origin.tolist(), float(size), depth)
+
+        if depth < self.max_depth:
+            face_min, face_max = face_min[kept], face_max[kept]
+            for child_origin in origin + CHILD_OFFSETS * size:
+                self.subdivide(face_min, face_max, child_origin, size / 2.0, depth + 1)
+
+    def generate_tiles(self):
+        # tiles are independent of each other. Threads are enough to keep every core busy:
+        # textures are converted by chopper's process pool and b3dm files by obj23dtiles.
+        # The pool is created here, before any tile thread is started
+        get_texture_pool()
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(gen_tile, *job): (children, obj) for job, children, obj in self.jobs}
+            for future in as_completed(futures):
+                children, obj = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # a tile of level 2 or more that fails is left out of the tileset
+                    if children is None:
+                        raise
+                    print("[exception in level 2 of octree]", e)
+                    children.remove(obj)
+
+    def write_tileset(self):
+        # the tileset is downloaded by the viewer, so it is written without whitespace
+        with open(self.tile_dir+'/tileset.json', 'w', encoding='utf-8') as f:
+            json.dump(self.tree, f, ensure_ascii=False, separators=(',', ':'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', help='path to .obj file (that links to .mtl with same name & 1 or more .png files linked from .mtl file)', type=str, required=True)
+    parser.add_argument('--output', help='path to new directory that will contain tileset.json and multiple .b3dm files', type=str, required=True)
+    parser.add_argument('--force', help='delete the output directory first if it already exists', action='store_true')
+    parser.add_argument('--max-depth', help='number of octree levels below the root tile', type=int, default=MAX_DEPTH)
+
+    args = parser.parse_args()
+
+    obj_path = op.abspath(args.input)
+    tile_dir = op.abspath(args.output)
+
+    assert op.exists(obj_path)
+    assert obj_path.endswith(".obj")
+    if args.force:
+        rmtree(tile_dir, ignore_errors=True)
+    assert not op.exists(tile_dir)
+    os.makedirs(tile_dir)
+
+    print("[a] Reading mesh from {}".format(obj_path))
+    # the parsed mesh is kept by the cropper and reused for every tile
+    vertices, faces, _ = read_obj(obj_path)
+
+    print("[b] Read mesh with {} vertices and {} faces".format(len(vertices), len(faces)))
+    # the root cell is a cube around the mesh, slightly larger than
+    # the mesh so that vertices on its upper bounds are inside of it
+    v_min, v_max = vertices.min(axis=0), vertices.max(axis=0)
+    size = (v_max - v_min).max() * 1.01
+    origin = (v_min + v_max) / 2.0 - size / 2.0
+
+    # bounds of every face, faces with vertex numbers the cropper can't resolve are left out
+    faces = faces[np.all((faces >= 1) & (faces <= len(vertices)), axis=1)]
+    face_vertices = vertices[faces - 1]
+    face_min, face_max = face_vertices.min(axis=1), face_vertices.max(axis=1)
+    del face_vertices
+
+    print("[c] Subdividing {:.2f} m cube at {}".format(size, origin))
+    builder = TilesetBuilder(tile_dir, obj_path, max_depth=args.max_depth)
+    builder.subdivide(face_min, face_max, origin, size)
+
+    print("[d] Created octree with {} tiles".format(builder.tree_counter + 1))
+
+    print("[e] Generating {} tiles".format(len(builder.jobs)))
+    builder.generate_tiles()
+
+    builder.write_tileset()
+
+    print("[f] Completed!")